@@ -11,7 +11,9 @@ License: GPLv2
 
 Requires
 annoy: https://github.com/spotify/annoy
+numpy: https://numpy.org/
 pillow: http://python-pillow.github.io/
+Optional: numba (faster gather), faiss (large-corpus backend)
 
 annabel.py is a tool for creating generative collages using
 approximate nearest neighbor search. Source images are cropped,
@@ -29,9 +31,43 @@ import sys
 from os import listdir
 from os.path import isfile, join
 from shutil import copyfile
-import pickle
+import json
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache, partial
+import numpy as np
 from annoy import AnnoyIndex
 from PIL import Image
+try:
+    import faiss
+except ImportError:  # faiss is optional; only the faiss backend needs it
+    faiss = None
+try:
+    from numba import njit, prange
+except ImportError:  # numba is optional; NumPy is used without it
+    njit = None
+
+if njit is not None:
+    @njit(parallel=True, cache=True)
+    def extract_tiles_jit(image_array, origins, out,
+                          crop_width, crop_height, sample_width, sample_height):
+        """
+        block-average every (crop_height, crop_width) tile at the given
+        origins down to a flat (sample_height, sample_width) feature row
+        """
+        block_height = crop_height // sample_height
+        block_width = crop_width // sample_width
+        scale = 1.0 / (block_height * block_width)
+        for t in prange(origins.shape[0]):
+            x, y = origins[t, 0], origins[t, 1]
+            for i in range(sample_height):
+                for j in range(sample_width):
+                    total = 0.0
+                    for di in range(block_height):
+                        for dj in range(block_width):
+                            total += image_array[y + i*block_height + di,
+                                                 x + j*block_width + dj]
+                    out[t, i*sample_width + j] = total * scale
 
 PROFILES_DIRECTORY = "profiles/"
 OUTPUT_DIRECTORY = "output/"
@@ -40,7 +76,8 @@ CROP_HEIGHT = 40
 CROP_WIDTH = 40
 CROP_INCREMENT = 20
 SAMPLE_DIMENSION = 10,10 # 10x10 (100) dimension vector sample
-TREE_SIZE = 5  # number of trees to create for ANN search.
+TREE_SIZE = 100  # default number of trees to create for ANN search.
+SEARCH_K = 10000  # default number of nodes to inspect per ANN query.
 
 
 def main():
@@ -65,6 +102,11 @@ def main():
         "-j", "-height", type=int, default=CROP_HEIGHT, help="crop height", dest="cheight")
     parser_a.add_argument(
         "-i", "-increment", type=int, default=CROP_INCREMENT, help="crop increment", dest="cincrement")
+    parser_a.add_argument(
+        "-t", "-trees", type=int, default=TREE_SIZE, help="number of annoy trees to build", dest="tree_count")
+    parser_a.add_argument(
+        "-b", "-backend", type=str, default="annoy", choices=["annoy", "faiss"],
+        help="ANN backend; faiss builds an IVF+PQ index for very large corpora", dest="backend")
 
     parser_b = subparsers.add_parser(
         "create", help="create a new collage given an image and a profile.")
@@ -74,6 +116,10 @@ def main():
                           required=True, help="profile to use", dest="profile_name")
     parser_b.add_argument("-c", "-count", type=int, action="store", default=1,
                           help="number of versions to output", dest="version_count")
+    parser_b.add_argument("-k", "-search-k", type=int, action="store", default=SEARCH_K,
+                          help="number of annoy nodes to inspect per query", dest="search_k")
+    parser_b.add_argument("-o", "-output-format", type=str, default="png", choices=["png", "jpeg"],
+                          help="output image format", dest="output_format")
 
     parser_c = subparsers.add_parser("list", help="list the available profiles.")
     
@@ -82,20 +128,85 @@ def main():
         parser.print_help()
     elif sys.argv[1] == "gather":
         create_profile(results.name, results.images_folder,
-                       results.cwidth, results.cheight, results.cincrement)
+                       results.cwidth, results.cheight, results.cincrement,
+                       results.tree_count, results.backend)
     elif sys.argv[1] == "create":
         create_collage(
-            results.input_image, results.profile_name, results.version_count)
+            results.input_image, results.profile_name, results.version_count,
+            results.search_k, results.output_format)
     elif sys.argv[1] == "list":
         list_profiles()
     return
 
 
-def create_profile(profile_name, image_folder, crop_width, crop_height, crop_increment):
+def tile_features(tile):
+    """
+    reduce a cropped grayscale tile (2d uint8 array) to a flat
+    SAMPLE_DIMENSION feature vector by averaging pixel blocks
+    """
+    sample_width, sample_height = SAMPLE_DIMENSION
+    crop_height, crop_width = tile.shape
+    if crop_height % sample_height or crop_width % sample_width:
+        # crop does not divide evenly into sample blocks, fall back to PIL
+        resized = Image.fromarray(tile).resize(SAMPLE_DIMENSION)
+        return np.frombuffer(resized.tobytes(), dtype=np.uint8).astype(np.float32)
+    blocks = tile.reshape(sample_height, crop_height // sample_height,
+                          sample_width, crop_width // sample_width)
+    return blocks.mean(axis=(1, 3), dtype=np.float32).ravel()
+
+
+def extract_image_features(image_file, profile_folder,
+                           crop_width, crop_height, crop_increment):
+    """
+    return the name, tile feature matrix and per-tile boxes of a source
+    image already copied into the profile. runs in a worker process
+    """
+    image_destination = profile_folder + "images/" + image_file
+    # convert once to a grayscale array so each tile is a cheap slice
+    image_array = np.asarray(
+        Image.open(image_destination).convert("L"), dtype=np.uint8)
+    image_height, image_width = image_array.shape
+    origins = [(x, y)
+               for x in range(0, image_width-crop_width, crop_increment)
+               for y in range(0, image_height-crop_height, crop_increment)]
+    sample_width, sample_height = SAMPLE_DIMENSION
+    features = np.empty(
+        (len(origins), sample_width*sample_height), dtype=np.float32)
+    divisible = not (crop_height % sample_height or crop_width % sample_width)
+    if njit is not None and divisible:
+        # compiled kernel averages all tiles in one parallel pass
+        extract_tiles_jit(image_array, np.asarray(origins, dtype=np.int64).reshape(-1, 2),
+                          features, crop_width, crop_height, sample_width, sample_height)
+    elif divisible and origins:
+        # one strided window gather plus a block-mean reduction builds
+        # every feature at once, with no per-tile Python calls
+        windows = np.lib.stride_tricks.sliding_window_view(
+            image_array, (crop_height, crop_width))
+        xs = np.arange(0, image_width-crop_width, crop_increment)
+        ys = np.arange(0, image_height-crop_height, crop_increment)
+        # transpose to x-major so feature rows line up with the origins
+        tiles = windows[np.ix_(ys, xs)].transpose(1, 0, 2, 3)
+        features[:] = tiles.reshape(
+            len(origins), sample_height, crop_height // sample_height,
+            sample_width, crop_width // sample_width).mean(
+                axis=(2, 4), dtype=np.float32).reshape(len(origins), -1)
+    else:
+        for i, (x, y) in enumerate(origins):
+            # dimensionality reduction via block averaging
+            features[i] = tile_features(image_array[y:y+crop_height, x:x+crop_width])
+    boxes = np.asarray([(x, y, x + crop_width, y + crop_height) for x, y in origins],
+                       dtype=np.int32).reshape(-1, 4)
+    return image_file, image_destination, features, boxes
+
+
+def create_profile(profile_name, image_folder, crop_width, crop_height, crop_increment,
+                   tree_count=TREE_SIZE, backend="annoy"):
     """
     given a folder and profile name, gather a series of subimages into a profile
     with which to create a collage
     """
+    if backend == "faiss" and faiss is None:
+        sys.exit("the faiss backend requires the faiss package (pip install faiss-cpu)")
     profile_folder = PROFILES_DIRECTORY + profile_name + "/"
     if not os.path.exists(profile_folder):
         os.makedirs(profile_folder)
@@ -104,82 +215,205 @@ def create_profile(profile_name, image_folder, crop_width, crop_height, crop_inc
     image_file_list = [
         f for f in listdir(image_folder) if isfile(join(image_folder, f))]
     # todo: use crop ratio to calculate variable vector size
-    nns_index = AnnoyIndex(SAMPLE_DIMENSION[0]*SAMPLE_DIMENSION[1], metric="euclidean")
-    image_index = []
-    index = 0
-    # iterate over images for processing into boxes and associated feature vectors
-    for image_file in image_file_list:
-        print("processing {}...".format(image_file),)
-        image_destination = profile_folder + "images/" + image_file
-        copyfile(image_folder + image_file, image_destination)
-        image = Image.open(image_destination)
-        image_width, image_height = image.size[0], image.size[1]
-        for x in range(0, image_width-crop_width, crop_increment):
-            for y in range(0, image_height-crop_height, crop_increment):
-                box = (x, y, x + crop_width, y + crop_height)
-                image_sample = image.crop(box).resize(
-                    SAMPLE_DIMENSION).convert("LA")  # dimensionality reduction
-                gs_pixeldata = []  # reset feature vector
-                # create feature vector for annoy
-                for pixel in list(image_sample.getdata()):
-                    gs_pixeldata.append(pixel[0])
-                # add feature vector to annoy
-                nns_index.add_item(index, gs_pixeldata)
-                image_index.insert(
-                    index, {"image": image_destination, "box": (x, y, x + crop_width, y + crop_height)})
-                index += 1
-        print("done.")
-    # image_index[-1] holds profile metadata.
-    image_index.append({"crop_width": crop_width, "crop_height": crop_height, "total_images": index-1})
+    feature_dimension = SAMPLE_DIMENSION[0]*SAMPLE_DIMENSION[1]
+    if backend == "annoy":
+        nns_index = AnnoyIndex(feature_dimension, metric="hamming")
+        # stream items to the mmap'd tree file so gather memory stays flat
+        # no matter how many subimages are indexed
+        nns_index.on_disk_build(profile_folder + profile_name + ".tree")
+    # subimages are stored struct-of-arrays: an (N, 4) box array and an
+    # (N,) image id array pointing into a list of source image paths.
+    # this keeps the serialized index small and lookups cheap at collage time
+    feature_chunks = []
+    box_chunks = []
+    image_id_chunks = []
+    image_paths = []
+    # process images into boxes and feature vectors across worker processes.
+    # a small thread pool copies source files ahead of the workers so the
+    # disk I/O overlaps with feature extraction
+    def copy_source(image_file):
+        copyfile(image_folder + image_file,
+                 profile_folder + "images/" + image_file)
+        return image_file
+    extract = partial(extract_image_features,
+                      profile_folder=profile_folder, crop_width=crop_width,
+                      crop_height=crop_height, crop_increment=crop_increment)
+    copier = ThreadPoolExecutor(max_workers=2)
+    copied = (future.result()
+              for future in as_completed([copier.submit(copy_source, f)
+                                          for f in image_file_list]))
+    with multiprocessing.Pool() as pool:
+        for image_file, image_destination, features, img_boxes in pool.imap_unordered(
+                extract, copied):
+            feature_chunks.append(features)
+            box_chunks.append(img_boxes)
+            image_id_chunks.append(
+                np.full(len(img_boxes), len(image_paths), dtype=np.int32))
+            image_paths.append(image_destination)
+            print("processed {} ({} subimages).".format(image_file, len(img_boxes)))
+    copier.shutdown()
+    features = np.concatenate(feature_chunks) if feature_chunks else np.empty(
+        (0, feature_dimension), dtype=np.float32)
+    boxes = np.concatenate(box_chunks) if box_chunks else np.empty((0, 4), dtype=np.int32)
+    image_ids = np.concatenate(image_id_chunks) if image_id_chunks else np.empty(0, dtype=np.int32)
+    index = len(features)
+    metadata = {"crop_width": crop_width, "crop_height": crop_height,
+                "sample_dimension": SAMPLE_DIMENSION,
+                "feature_dimension": feature_dimension,
+                "backend": backend,
+                "tree_count": tree_count,
+                "total_images": index-1}
     print("{} total subimages to be indexed...".format(str(index-1)))
-    print("building trees (this can take awhile)...")
-    nns_index.build(TREE_SIZE)  # annoy builds trees
-    print("done.")
-    print("serializing trees..."),
-    nns_index.save(profile_folder + profile_name + ".tree")
-    print("done.")
+    if backend == "faiss":
+        # coarse IVF routing plus product quantization compresses each
+        # feature to ~10 bytes and prunes candidates before distances
+        print("training product quantizer (this can take awhile)...")
+        # scale the cluster counts down for small corpora; training needs
+        # at least as many points as centroids
+        nlist = min(256, max(1, index // 39))
+        nbits = min(8, max(1, int(np.log2(max(index, 2)))))
+        quantizer = faiss.IndexFlatL2(feature_dimension)
+        faiss_index = faiss.IndexIVFPQ(quantizer, feature_dimension, nlist, 10, nbits)
+        faiss_index.train(features)
+        faiss_index.add(features)
+        faiss.write_index(faiss_index, profile_folder + profile_name + ".faiss")
+        print("done.")
+    else:
+        # quantize each grayscale feature to one bit against the per-profile
+        # median brightness; hamming is annoy's fastest metric and the index
+        # shrinks accordingly. the threshold is kept for query time.
+        # annoy's add_item is not process-safe, so the adds stay in the parent
+        threshold = (np.median(features, axis=0).astype(np.float32)
+                     if index else np.zeros(feature_dimension, dtype=np.float32))
+        bits = (features > threshold).astype(np.uint8)
+        for i in range(index):
+            nns_index.add_item(i, bits[i])
+        metadata["metric"] = "hamming"
+        metadata["threshold"] = threshold.tolist()
+        print("building trees (this can take awhile)...")
+        nns_index.build(tree_count)  # annoy builds trees, written in place on disk
+        print("done.")
     print("serializing index..."),
-    pickle.dump(image_index, open(profile_folder + profile_name + ".p", "wb"))
+    # the box and image id arrays go in an .npz that loads without
+    # deserializing every entry; paths and metadata stay in a small json
+    np.savez(profile_folder + profile_name + ".npz",
+             boxes=boxes, image_ids=image_ids)
+    with open(profile_folder + profile_name + ".json", "w") as profile_file:
+        json.dump({"image_paths": image_paths, "metadata": metadata}, profile_file)
     print("done.")
     print("{} profile completed. Saved in {}".format(profile_name, profile_folder))
     return
 
 
-def create_collage(input_image, profile_name, version_count):
+@lru_cache(maxsize=256)
+def open_source_image(path):
+    """
+    open and fully decode a source image, cached so tiles that share a
+    source image only pay the file read and decode once
+    """
+    image = Image.open(path)
+    image.load()
+    return image
+
+
+def create_collage(input_image, profile_name, version_count, search_k=SEARCH_K,
+                   output_format="png"):
     """
     given an input image and an existing profile, create a set of new collages
     """
     profile_folder = PROFILES_DIRECTORY + profile_name + "/"
     if not os.path.exists(OUTPUT_DIRECTORY):
         os.makedirs(OUTPUT_DIRECTORY)
-    # todo: load feature dimensions from profile
-    nns_index = AnnoyIndex(SAMPLE_DIMENSION[0]*SAMPLE_DIMENSION[1], metric="euclidean")
-    print("loading trees...")
-    nns_index.load(profile_folder + profile_name + ".tree")
-    print("done.")
-    subimage_index = pickle.load(
-        open(profile_folder + profile_name + ".p", "rb"))
+    # the box and image id arrays memory-map straight from the .npz, so
+    # startup doesn't deserialize every subimage entry
+    arrays = np.load(profile_folder + profile_name + ".npz", mmap_mode="r")
+    boxes, image_ids = arrays["boxes"], arrays["image_ids"]
+    with open(profile_folder + profile_name + ".json") as profile_file:
+        profile = json.load(profile_file)
+    image_paths, metadata = profile["image_paths"], profile["metadata"]
+    # feature dimensions come from the profile; older profiles fall back
+    # to the compiled-in defaults
+    sample_dimension = tuple(metadata.get("sample_dimension", SAMPLE_DIMENSION))
+    feature_dimension = metadata.get(
+        "feature_dimension", SAMPLE_DIMENSION[0]*SAMPLE_DIMENSION[1])
+    backend = metadata.get("backend", "annoy")
+    threshold = metadata.get("threshold")
+    if threshold is not None:
+        threshold = np.asarray(threshold, dtype=np.float32)
+    if backend == "faiss":
+        if faiss is None:
+            sys.exit("this profile requires the faiss package (pip install faiss-cpu)")
+        print("loading faiss index...")
+        faiss_index = faiss.read_index(profile_folder + profile_name + ".faiss")
+        faiss_index.nprobe = 8
+        print("done.")
+    else:
+        # profiles gathered before the hamming switch carry no metric key
+        metric = metadata.get("metric", "euclidean")
+        nns_index = AnnoyIndex(feature_dimension, metric=metric)
+        print("loading trees...")
+        # prefault pages the whole index in sequentially up front, which
+        # beats random-order faults during the first queries
+        nns_index.load(profile_folder + profile_name + ".tree", prefault=True)
+        print("done.")
     template_image = Image.open(input_image)
     image_width, image_height = template_image.size[0], template_image.size[1]
-    crop_width, crop_height = subimage_index[-1]["crop_width"], subimage_index[-1]["crop_height"]
+    crop_width, crop_height = metadata["crop_width"], metadata["crop_height"]
+    tiles = [(x, y)
+             for x in range(0, image_width-crop_width, crop_width)
+             for y in range(0, image_height-crop_height, crop_height)]
+    # extract each template tile's feature once and fetch the neighbors
+    # for every version in a single query, instead of repeating both
+    # per version
+    def extract_tile(origin):
+        x, y = origin
+        crop_sample = template_image.crop(
+            (x, y, x + crop_width, y + crop_height)).convert("L").resize(sample_dimension)
+        # frombuffer views PIL's raw gray bytes without an intermediate list
+        return np.frombuffer(crop_sample.tobytes(), dtype=np.uint8)
+    template_image.load()  # decode up front; threads only read afterwards
+    queries = np.empty((len(tiles), feature_dimension), dtype=np.float32)
+    # PIL's crop, convert and resize release the GIL, so threads scale here
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        for t, feature in enumerate(executor.map(extract_tile, tiles)):
+            queries[t] = feature
+    if backend == "faiss":
+        neighbors = faiss_index.search(queries, version_count)[1]
+    else:
+        if threshold is not None:
+            # quantize the queries the same way the profile was indexed
+            queries = (queries > threshold).astype(np.uint8)
+        # annoy has no batch API, but its queries release the GIL, so a
+        # thread pool amortizes the per-tile tree descents
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            neighbors = list(executor.map(
+                lambda q: nns_index.get_nns_by_vector(q, version_count, search_k=search_k),
+                queries))
+    # crop each distinct neighbor exactly once; collages reuse many of
+    # the same subimages across tiles and versions
+    substitute_crops = {}
+    for neighbor_list in neighbors:
+        for image_neighbor in neighbor_list:
+            if image_neighbor >= 0 and image_neighbor not in substitute_crops:
+                substitute_image = open_source_image(image_paths[image_ids[image_neighbor]])
+                substitute_crops[image_neighbor] = substitute_image.crop(
+                    tuple(boxes[image_neighbor]))
     for i in range(version_count):
         print("Creating collage {}/{}...".format(i+1, version_count))
         output_image = template_image.copy()
-        for x in range(0, image_width-crop_width, crop_width):
-            for y in range(0, image_height-crop_height, crop_height):
-                box = (x, y, x + crop_width, y + crop_height)
-                crop_box = output_image.crop(box)
-                crop_sample = crop_box.convert("LA").resize(SAMPLE_DIMENSION)
-                gs_pixeldata = []
-                for pixel in list(crop_sample.getdata()):
-                    gs_pixeldata.append(pixel[0])
-                image_neighbor = nns_index.get_nns_by_vector(gs_pixeldata, version_count)[i]
-                substitute_image = Image.open(subimage_index[image_neighbor]["image"])
-                substitute_crop = substitute_image.crop(
-                subimage_index[image_neighbor]["box"])
+        for t, (x, y) in enumerate(tiles):
+            box = (x, y, x + crop_width, y + crop_height)
+            substitute_crop = substitute_crops.get(neighbors[t][i])
+            if substitute_crop is not None:
                 output_image.paste(substitute_crop, box)
-        output_path = OUTPUT_DIRECTORY + str(i) + ".png"
-        output_image.save(output_path, "PNG")
+        output_path = OUTPUT_DIRECTORY + str(i) + "." + output_format
+        if output_format == "jpeg":
+            output_image.convert("RGB").save(
+                output_path, "JPEG", quality=92, subsampling=2)
+        else:
+            # zlib level 1 encodes several times faster than the default
+            # level 6 at a modest file-size cost
+            output_image.save(output_path, "PNG", compress_level=1)
         print("done.")
     print("{} image(s) saved in {}".format(version_count, OUTPUT_DIRECTORY))
     return
@@ -192,10 +426,10 @@ def list_profiles():
     print("Available Profiles:")
     print("{0:<15} {1:<15} {2:<8}".format("name", "# of images", "size (px)"))
     for directory in os.listdir(PROFILES_DIRECTORY):
-        subimage_index = pickle.load(
-            open(PROFILES_DIRECTORY + directory + "/" + directory + ".p", "rb"))
-        total_images = subimage_index[-1]["total_images"]
-        crop_size = str(subimage_index[-1]["crop_width"]) + "x" + str(subimage_index[-1]["crop_height"])
+        with open(PROFILES_DIRECTORY + directory + "/" + directory + ".json") as profile_file:
+            metadata = json.load(profile_file)["metadata"]
+        total_images = metadata["total_images"]
+        crop_size = str(metadata["crop_width"]) + "x" + str(metadata["crop_height"])
         print("{0:<15} {1:<15} {2:<8}".format(directory, total_images, crop_size))
     return
 